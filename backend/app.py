@@ -7,19 +7,56 @@ Provides REST API endpoints for GPT-2 model analysis including:
 - Attention weight computation
 - Next token prediction
 
-Uses transformers library with GPT-2 model and sklearn for PCA.
+Uses transformers library with GPT-2 model and torch.pca_lowrank for PCA.
 """
 
+import asyncio
+import base64
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+import inspect
+import os
+import threading
+from types import SimpleNamespace
+from typing import Optional
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware  # ✅ CORS
-from pydantic import BaseModel
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
+from fastapi.responses import ORJSONResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, field_validator
+import transformers
+from transformers import DynamicCache, GPT2LMHeadModel, GPT2TokenizerFast
 import torch
-from sklearn.decomposition import PCA
-import numpy as np
+
+# Optional: serve the batched forward through ONNX Runtime on CPU
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
 
 
-app = FastAPI(title="LLM Visualization API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the micro-batching worker for the lifetime of the server"""
+    global _batch_queue
+    _batch_queue = asyncio.Queue()
+    worker = asyncio.create_task(_batch_worker())
+    yield
+    worker.cancel()
+
+
+# orjson serializes NumPy arrays natively. Heavy endpoints build their ORJSONResponse
+# in the threadpool (rendering happens in its constructor), which also skips
+# FastAPI's jsonable_encoder pass and keeps the event loop free for batching.
+app = FastAPI(
+    title="LLM Visualization API",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 # ✅ Allow frontend (React @ localhost:5173) to make API calls
 app.add_middleware(
@@ -30,11 +67,41 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def _pick_dtype() -> torch.dtype:
+    """BF16 when the device runs it natively (Ampere+ GPUs, AVX-512 BF16 / AMX CPUs), FP32 otherwise"""
+    if DEVICE == "cuda":
+        # is_bf16_supported() also reports emulated BF16 (e.g. T4/V100); tensor cores need sm_80+
+        return torch.bfloat16 if torch.cuda.get_device_capability() >= (8, 0) else torch.float32
+    # _is_mkldnn_bf16_supported() is also true on plain AVX-512 (Skylake/Cascade Lake),
+    # where BF16 is emulated and slower than FP32; require the native instructions
+    try:
+        native_bf16 = torch._C._cpu._is_avx512_bf16_supported() or torch._C._cpu._is_amx_tile_supported()
+    except Exception:
+        native_bf16 = False
+    return torch.bfloat16 if native_bf16 else torch.float32
+
+
+MODEL_DTYPE = _pick_dtype()
+
+# Grad mode is thread-local, so this covers startup work (loading, warm-up) on the
+# main thread; forwards in worker threads still enter torch.inference_mode()
+torch.set_grad_enabled(False)
+
 # Load tokenizer and model (GPT-2)
 try:
-    tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
-    model = GPT2LMHeadModel.from_pretrained("gpt2", output_hidden_states=True, output_attentions=True)
+    tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
+    # Hidden states / attentions are requested per call, only where an endpoint needs them
+    model = GPT2LMHeadModel.from_pretrained("gpt2")
+    model = model.to(device=DEVICE, dtype=MODEL_DTYPE)
     model.eval()
+    # Inference only: frozen parameters never record autograd state, in any thread
+    for param in model.parameters():
+        param.requires_grad_(False)
+    # Compiled lazily on first call; warmed up below once _forward is defined
+    compiled_model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
     # GPT-2 tokenizer doesn't have a pad token by default
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
@@ -42,11 +109,556 @@ except Exception as e:
     print("Model/tokenizer load error:", e)
     tokenizer = None
     model = None
+    compiled_model = None
+
+# Attention maps grow as O(seq_len^2) per head and layer, so inputs are truncated
+# to MAX_INPUT_TOKENS, and texts over MAX_TEXT_BYTES are refused before tokenization
+MAX_INPUT_TOKENS = 512
+MAX_TEXT_BYTES = 16 * 1024
+
+# Exported once on first start when onnxruntime is installed; delete to re-export
+ONNX_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gpt2.onnx")
+# Written when export/loading/validation fails so later starts with the same library
+# versions skip straight to PyTorch; delete it (or upgrade) to try again
+ONNX_FAILED_PATH = f"{ONNX_MODEL_PATH}.failed"
+# Right-padded batches like the ones _forward sends: the export is traced on the
+# first and checked against PyTorch on the second, whose batch size and lengths
+# differ, so a graph that baked in its trace shape or mask handling is rejected
+ONNX_TRACE_TEXTS = ("Hello world, this is", "A short one")
+ONNX_CHECK_TEXTS = (
+    "The quick brown fox jumps over the lazy dog",
+    "Attention is all you need",
+    "GPT-2 predicts the next token",
+)
+
+# Inputs are right-padded up to one of these lengths so the compiled model only
+# ever sees a handful of shapes instead of recompiling for every prompt length
+SEQ_LEN_BUCKETS = (16, 32, 64, 128, 256, 512)
+
+# Upper bound on the past_key_values kept for /next_token sessions
+SESSION_CACHE_MAX_MB = 512
+# session_id -> (token ids covered by the cache, DynamicCache), least recently used first
+SESSION_CACHE = OrderedDict()
+
+# Concurrent requests arriving within BATCH_WAIT_SECONDS share one forward pass
+MAX_BATCH = 16
+BATCH_WAIT_SECONDS = 0.005
+# (text, input_ids, future) items waiting for the batch worker; created in lifespan
+_batch_queue = None
+
+# Full attention maps are large (~150 MB at MAX_INPUT_TOKENS), so the cache is
+# bounded by size rather than entry count, and kept in host memory
+OUTPUT_CACHE_MAX_MB = 1024
+# text -> ModelOutputs, least recently used first; only touched from the event loop
+_OUTPUT_CACHE = OrderedDict()
+_output_cache_bytes = 0
+
+# /embeddings projects onto a shared PCA basis, fitted on the first prompt with at
+# least PCA_MIN_FIT_TOKENS tokens and refitted after PCA_REFIT_EVERY uses or when
+# it captures less than PCA_MIN_EXPLAINED_VARIANCE of a new prompt's variance
+PCA_MIN_FIT_TOKENS = 16
+PCA_REFIT_EVERY = 100
+PCA_MIN_EXPLAINED_VARIANCE = 0.5
+# mean: [hidden_dim], components: [hidden_dim, 3], both CPU tensors; guarded by _pca_lock
+_pca_basis = {"mean": None, "components": None, "uses": 0}
+_pca_lock = threading.Lock()
 
 
 class TextInput(BaseModel):
     """Request model for text input endpoints"""
     text: str
+    # /next_token only: reuse the KV cache from this session's previous prompt
+    session_id: Optional[str] = None
+
+    @field_validator("text")
+    @classmethod
+    def check_text_size(cls, text: str) -> str:
+        """Reject oversized texts before they reach the tokenizer"""
+        if len(text.encode("utf-8")) > MAX_TEXT_BYTES:
+            raise ValueError(f"text exceeds {MAX_TEXT_BYTES} bytes")
+        return text
+
+
+@dataclass(frozen=True)
+class ModelOutputs:
+    """Result of a single GPT-2 forward pass, shared by every endpoint"""
+    input_ids: torch.Tensor  # [seq_len]
+    hidden_states: tuple  # (num_layers + 1) x [seq_len, hidden_dim]
+    attentions: tuple  # num_layers x [num_heads, seq_len, seq_len]
+    next_token_logits: torch.Tensor  # [vocab_size]
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the tensors, used to bound the output cache"""
+        tensors = (self.input_ids, *self.hidden_states, *self.attentions, self.next_token_logits)
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+
+# Batched forward passes and /next_token session prefills run in worker threads
+_model_lock = threading.Lock()
+
+
+def _bucket_length(seq_len: int) -> int:
+    """Smallest bucket that fits seq_len (or seq_len itself if none does)"""
+    return next((bucket for bucket in SEQ_LEN_BUCKETS if bucket >= seq_len), seq_len)
+
+
+@lru_cache(maxsize=2048)
+def _tok(text: str) -> tuple:
+    """
+    Tokenize text once per unique string, truncated to MAX_INPUT_TOKENS
+
+    The returned tensors are shared between callers and must never be modified in place.
+
+    Args:
+        text: Input text
+
+    Returns:
+        tuple: (input_ids, attention_mask) CPU tensors, each of shape [seq_len]
+    """
+    inputs = tokenizer(
+        text,
+        return_tensors="pt",
+        truncation=True,
+        max_length=MAX_INPUT_TOKENS,
+        add_special_tokens=True,
+    )
+    return inputs["input_ids"][0], inputs["attention_mask"][0]
+
+
+def _pad_batch(batch_ids: list, padded_len: int) -> tuple:
+    """
+    Right-pad token id tensors into one batch
+
+    Args:
+        batch_ids: Token id tensors, each of shape [seq_len]
+        padded_len: Length to pad to (at least the longest sequence)
+
+    Returns:
+        tuple: (padded_ids, attention_mask), each of shape [batch, padded_len], with
+            the mask 1 for real tokens and 0 for padding
+    """
+    padded_ids = torch.full((len(batch_ids), padded_len), tokenizer.pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros_like(padded_ids)
+    for row, ids in enumerate(batch_ids):
+        padded_ids[row, :len(ids)] = ids
+        attention_mask[row, :len(ids)] = 1
+    return padded_ids, attention_mask
+
+
+def _forward(batch_ids: list):
+    """
+    Run the compiled model on a batch of sequences right-padded to a length bucket
+    (or, with ONNX Runtime and its dynamic axes, just to the longest sequence)
+
+    Padding only ever follows the real tokens, so the causal mask keeps it from
+    affecting their hidden states, attentions or logits.
+
+    Args:
+        batch_ids: Token id tensors, each of shape [seq_len]
+
+    Returns:
+        Model outputs for the padded batch; callers slice off the padding
+    """
+    global compiled_model, onnx_session
+    max_len = max(len(ids) for ids in batch_ids)
+    # Buckets only exist to bound torch.compile's shapes
+    padded_len = max_len if onnx_session is not None else _bucket_length(max_len)
+    padded_ids, attention_mask = _pad_batch(batch_ids, padded_len)
+    if onnx_session is not None:
+        try:
+            return _forward_onnx(onnx_session, padded_ids, attention_mask)
+        except Exception as e:
+            # Same idea as the compile fallback below: if the eager model handles the
+            # same inputs, ONNX Runtime is at fault and is dropped for good
+            with torch.inference_mode():
+                outputs = model(
+                    input_ids=padded_ids,
+                    attention_mask=attention_mask,
+                    use_cache=False,
+                    output_hidden_states=True,
+                    output_attentions=True,
+                )
+            print("ONNX Runtime failed for shape", tuple(padded_ids.shape), "- falling back to PyTorch:", e)
+            onnx_session = None
+            return outputs
+    inputs = dict(
+        input_ids=padded_ids.to(DEVICE),
+        attention_mask=attention_mask.to(DEVICE),
+        use_cache=False,
+        output_hidden_states=True,
+        output_attentions=True,
+    )
+    with torch.inference_mode(), torch.autocast(device_type=DEVICE, dtype=MODEL_DTYPE, enabled=MODEL_DTYPE != torch.float32):
+        try:
+            return compiled_model(**inputs)
+        except Exception as e:
+            if compiled_model is model:
+                raise
+            # Each new (batch, bucket) shape compiles on a live request; if the eager
+            # model handles the same inputs, the compiled path is at fault
+            outputs = model(**inputs)
+            print("torch.compile failed for shape", tuple(padded_ids.shape), "- falling back to eager model:", e)
+            compiled_model = model
+            return outputs
+
+
+class _TupleOutputs(torch.nn.Module):
+    """GPT-2 returning a flat (logits, *hidden_states, *attentions) tuple, which ONNX export can handle"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            use_cache=False,
+            output_hidden_states=True,
+            output_attentions=True,
+        )
+        return (outputs.logits, *outputs.hidden_states, *outputs.attentions)
+
+
+def _load_onnx_session():
+    """
+    Export the model to ONNX (once) and load it into ONNX Runtime
+
+    The export goes to a temporary file that is renamed into place, so an
+    interrupted or concurrent start never leaves a partial model behind. The
+    session is only used if its outputs on a padded batch of a different shape
+    than the traced one match PyTorch's on every real (unpadded) position. A
+    failure is recorded with the torch/transformers/onnxruntime versions that hit
+    it, so restarts on the same stack don't pay for a doomed export again.
+
+    Returns:
+        ort.InferenceSession, or None to keep the PyTorch path when onnxruntime is not
+        installed, the model runs on CUDA or in BF16, or export/loading/validation fails
+    """
+    if ort is None or model is None or DEVICE != "cpu" or MODEL_DTYPE != torch.float32:
+        return None
+    versions = f"torch {torch.__version__}, transformers {transformers.__version__}, onnxruntime {ort.__version__}"
+    if os.path.exists(ONNX_FAILED_PATH):
+        with open(ONNX_FAILED_PATH) as f:
+            if f.read() == versions:
+                print(f"ONNX previously failed with {versions}, using PyTorch (delete {ONNX_FAILED_PATH} to retry)")
+                return None
+    num_layers = model.config.n_layer
+    hidden_names = [f"hidden_state_{i}" for i in range(num_layers + 1)]
+    attention_names = [f"attention_{i}" for i in range(num_layers)]
+    dynamic_axes = {
+        "input_ids": {0: "batch", 1: "seq"},
+        "attention_mask": {0: "batch", 1: "seq"},
+        "logits": {0: "batch", 1: "seq"},
+        **{name: {0: "batch", 1: "seq"} for name in hidden_names},
+        **{name: {0: "batch", 2: "seq", 3: "seq"} for name in attention_names},
+    }
+    trace_ids = [_tok(text)[0] for text in ONNX_TRACE_TEXTS]
+    trace_ids, trace_mask = _pad_batch(trace_ids, max(len(ids) for ids in trace_ids))
+    check_ids = [_tok(text)[0] for text in ONNX_CHECK_TEXTS]
+    check_lengths = [len(ids) for ids in check_ids]
+    check_ids, check_mask = _pad_batch(check_ids, max(check_lengths))
+    # Newer torch defaults to the dynamo exporter, which needs onnxscript and takes
+    # dynamic_shapes rather than dynamic_axes; older torch has no such argument
+    export_kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    tmp_path = f"{ONNX_MODEL_PATH}.{os.getpid()}.tmp"
+    try:
+        if not os.path.exists(ONNX_MODEL_PATH):
+            torch.onnx.export(
+                _TupleOutputs(model),
+                (trace_ids, trace_mask),
+                tmp_path,
+                input_names=["input_ids", "attention_mask"],
+                output_names=["logits", *hidden_names, *attention_names],
+                dynamic_axes=dynamic_axes,
+                opset_version=17,
+                **export_kwargs,
+            )
+            os.replace(tmp_path, ONNX_MODEL_PATH)
+        session = ort.InferenceSession(ONNX_MODEL_PATH, providers=["CPUExecutionProvider"])
+
+        # Only adopt the session if it reproduces the PyTorch model
+        actual = _forward_onnx(session, check_ids, check_mask)
+        with torch.inference_mode():
+            expected = model(
+                input_ids=check_ids,
+                attention_mask=check_mask,
+                use_cache=False,
+                output_hidden_states=True,
+                output_attentions=True,
+            )
+        for row, seq_len in enumerate(check_lengths):
+            torch.testing.assert_close(
+                actual.logits[row, :seq_len], expected.logits[row, :seq_len], rtol=1e-3, atol=1e-3
+            )
+            torch.testing.assert_close(
+                [layer[row, :seq_len] for layer in actual.hidden_states],
+                [layer[row, :seq_len] for layer in expected.hidden_states],
+                rtol=1e-3, atol=1e-3,
+            )
+            torch.testing.assert_close(
+                [layer[row, :, :seq_len, :seq_len] for layer in actual.attentions],
+                [layer[row, :, :seq_len, :seq_len] for layer in expected.attentions],
+                rtol=1e-3, atol=1e-3,
+            )
+        if os.path.exists(ONNX_FAILED_PATH):
+            os.remove(ONNX_FAILED_PATH)
+        return session
+    except Exception as e:
+        print("ONNX export/load/validation failed, using PyTorch:", e)
+        # A stale or broken export would otherwise keep failing on every start
+        for path in (tmp_path, ONNX_MODEL_PATH):
+            if os.path.exists(path):
+                os.remove(path)
+        with open(ONNX_FAILED_PATH, "w") as f:
+            f.write(versions)
+        return None
+
+
+def _forward_onnx(session, padded_ids: torch.Tensor, attention_mask: torch.Tensor):
+    """
+    Run an ONNX Runtime session, shaping its outputs like the PyTorch model's
+
+    Args:
+        session: ort.InferenceSession for the exported model
+        padded_ids: Token ids, shape [batch, padded_len]
+        attention_mask: 1 for real tokens, 0 for padding, same shape
+
+    Returns:
+        SimpleNamespace: logits, hidden_states and attentions as CPU tensors
+    """
+    outputs = session.run(None, {
+        "input_ids": padded_ids.numpy(),
+        "attention_mask": attention_mask.numpy(),
+    })
+    num_layers = model.config.n_layer
+    tensors = [torch.from_numpy(output) for output in outputs]
+    return SimpleNamespace(
+        logits=tensors[0],
+        hidden_states=tuple(tensors[1:num_layers + 2]),
+        attentions=tuple(tensors[num_layers + 2:]),
+    )
+
+
+onnx_session = _load_onnx_session()
+
+
+def _warm_up():
+    """Compile (or, with ONNX Runtime, initialize) the smallest bucket at startup so the first request isn't slow"""
+    global compiled_model, onnx_session
+    if compiled_model is None:
+        return
+    try:
+        _forward([_tok("Hello world")[0]])
+    except Exception as e:
+        if onnx_session is not None:
+            print("ONNX Runtime warm-up failed, falling back to PyTorch:", e)
+            onnx_session = None
+        else:
+            print("torch.compile warm-up failed, falling back to eager model:", e)
+            compiled_model = model
+
+
+_warm_up()
+
+
+def _to_host(tensor: torch.Tensor) -> torch.Tensor:
+    """Detached FP32 CPU copy that shares no storage with the model output"""
+    return tensor.detach().to("cpu", dtype=torch.float32, copy=True)
+
+
+def _run_model_batch(batch_ids: list) -> list:
+    """
+    Run one forward pass over a batch, collecting everything the endpoints need
+
+    Args:
+        batch_ids: Token id tensors, each of shape [seq_len]
+
+    Returns:
+        list[ModelOutputs]: One per sequence, as detached FP32 CPU tensors with padding removed
+    """
+    results = []
+    with _model_lock:
+        outputs = _forward(batch_ids)
+        # Copy every slice to the host: views would keep the whole padded batch alive
+        # in the cache, and with CUDA graphs they alias buffers the next replay overwrites
+        for row, ids in enumerate(batch_ids):
+            seq_len = len(ids)
+            results.append(ModelOutputs(
+                input_ids=ids,
+                hidden_states=tuple(_to_host(layer[row, :seq_len]) for layer in outputs.hidden_states),
+                attentions=tuple(_to_host(layer[row, :, :seq_len, :seq_len]) for layer in outputs.attentions),
+                next_token_logits=_to_host(outputs.logits[row, seq_len - 1]),
+            ))
+    return results
+
+
+def _cache_outputs(text: str, outputs: ModelOutputs):
+    """Insert into the output cache, evicting least recently used entries beyond OUTPUT_CACHE_MAX_MB"""
+    global _output_cache_bytes
+    if text in _OUTPUT_CACHE:
+        _output_cache_bytes -= _OUTPUT_CACHE.pop(text).nbytes
+    _OUTPUT_CACHE[text] = outputs
+    _output_cache_bytes += outputs.nbytes
+    while len(_OUTPUT_CACHE) > 1 and _output_cache_bytes > OUTPUT_CACHE_MAX_MB * 2**20:
+        _output_cache_bytes -= _OUTPUT_CACHE.popitem(last=False)[1].nbytes
+
+
+async def _batch_worker():
+    """Collect queued requests into batches of up to MAX_BATCH and resolve their futures"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _batch_queue.get()]
+        deadline = loop.time() + BATCH_WAIT_SECONDS
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Identical prompts (e.g. the frontend's parallel calls) share one row, and
+        # prompts finished by an earlier batch are taken from the cache up front
+        resolved = {text: _OUTPUT_CACHE[text] for text, _, _ in batch if text in _OUTPUT_CACHE}
+        pending = {text: ids for text, ids, _ in batch if text not in resolved}
+        try:
+            if pending:
+                results = await loop.run_in_executor(None, _run_model_batch, list(pending.values()))
+                for text, result in zip(pending, results):
+                    resolved[text] = result
+                    _cache_outputs(text, result)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        for text, _, future in batch:
+            if not future.done():
+                future.set_result(resolved[text])
+
+
+async def get_model_outputs(text: str) -> ModelOutputs:
+    """Return the (possibly cached) forward pass results for text, batching with concurrent requests"""
+    if text in _OUTPUT_CACHE:
+        _OUTPUT_CACHE.move_to_end(text)
+        return _OUTPUT_CACHE[text]
+    input_ids, _ = await run_in_threadpool(_tok, text)
+    if len(input_ids) == 0:
+        raise ValueError("empty input")
+    future = asyncio.get_running_loop().create_future()
+    await _batch_queue.put((text, input_ids, future))
+    return await future
+
+
+def _evict_sessions():
+    """Drop least recently used sessions until the cached keys/values fit in SESSION_CACHE_MAX_MB"""
+    bytes_per_token = 2 * model.config.n_layer * model.config.n_embd * MODEL_DTYPE.itemsize
+    cached_tokens = sum(len(ids) for ids, _ in SESSION_CACHE.values())
+    while SESSION_CACHE and cached_tokens * bytes_per_token > SESSION_CACHE_MAX_MB * 2**20:
+        ids, _ = SESSION_CACHE.popitem(last=False)[1]
+        cached_tokens -= len(ids)
+
+
+def session_next_token_logits(session_id: str, text: str) -> torch.Tensor:
+    """
+    Next-token logits for text, prefilling only what differs from the session's previous prompt
+
+    The session's cached keys/values are cropped to the longest common token
+    prefix with text, and only the remaining suffix is run through the model.
+
+    Args:
+        session_id: Client-chosen session identifier
+        text: Full prompt (not just the new suffix)
+
+    Returns:
+        torch.Tensor: Logits for the last position, shape [vocab_size]
+    """
+    input_ids, _ = _tok(text)
+    if len(input_ids) == 0:
+        raise ValueError("empty input")
+    with _model_lock:
+        prev_ids, past_key_values = SESSION_CACHE.pop(session_id, (None, None))
+        prefix_len = 0
+        if prev_ids is not None:
+            common = min(len(prev_ids), len(input_ids))
+            mismatches = (prev_ids[:common] != input_ids[:common]).nonzero()
+            prefix_len = mismatches[0].item() if len(mismatches) else common
+        # Always feed at least the last token so there are logits to read
+        prefix_len = min(prefix_len, len(input_ids) - 1)
+        with torch.inference_mode(), torch.autocast(device_type=DEVICE, dtype=MODEL_DTYPE, enabled=MODEL_DTYPE != torch.float32):
+            if prefix_len == 0:
+                past_key_values = DynamicCache()
+            else:
+                past_key_values.crop(prefix_len)
+            outputs = model(
+                input_ids=input_ids[prefix_len:].unsqueeze(0).to(DEVICE),
+                past_key_values=past_key_values,
+                use_cache=True,
+                output_hidden_states=False,
+                output_attentions=False,
+            )
+        SESSION_CACHE[session_id] = (input_ids, outputs.past_key_values)
+        _evict_sessions()
+    return outputs.logits[0, -1].detach().float()
+
+
+def encode_tensor(tensor: torch.Tensor, dtype: str = "float16") -> dict:
+    """
+    Pack a tensor as a base64 buffer instead of nested JSON lists
+
+    Args:
+        tensor: Tensor of any shape
+        dtype: "float16", "float32", or "uint8" for values in [0, 1] quantized to round(x * 255)
+
+    Returns:
+        dict: dtype, shape and base64-encoded little-endian data (decoded by the frontend api client)
+    """
+    if dtype == "uint8":
+        array = (tensor.detach() * 255).round().to(torch.uint8).cpu().numpy()
+    elif dtype == "float32":
+        array = tensor.detach().to(torch.float32).cpu().numpy().astype("<f4", copy=False)
+    else:
+        array = tensor.detach().to(torch.float16).cpu().numpy().astype("<f2", copy=False)
+    return {
+        "dtype": dtype,
+        "shape": list(array.shape),
+        "data": base64.b64encode(array.tobytes()).decode("ascii")
+    }
+
+
+def project_3d(hidden: torch.Tensor) -> Optional[torch.Tensor]:
+    """
+    Project hidden states onto 3 principal components, reusing the shared basis when it fits
+
+    Runs on the CPU: model outputs are cached as FP32 host copies, and a
+    [seq_len, 768] x [768, 3] projection isn't worth a round trip to the GPU.
+
+    Args:
+        hidden: Hidden states on the host, shape [seq_len, hidden_dim]
+
+    Returns:
+        torch.Tensor: Coordinates of shape [seq_len, 3], or None if there is no
+            shared basis yet and too few tokens to fit one
+    """
+    with _pca_lock:
+        if _pca_basis["components"] is not None and _pca_basis["uses"] < PCA_REFIT_EVERY:
+            centered = hidden - _pca_basis["mean"]
+            projected = torch.matmul(centered, _pca_basis["components"])
+            explained = projected.pow(2).sum() / centered.pow(2).sum().clamp_min(1e-12)
+            if explained.item() >= PCA_MIN_EXPLAINED_VARIANCE:
+                _pca_basis["uses"] += 1
+                return projected
+        if min(hidden.shape) < 3:
+            return None
+        # Randomized 3-component SVD instead of a full one
+        mean = hidden.mean(dim=0)
+        _, _, V = torch.pca_lowrank(hidden, q=3)
+        if hidden.shape[0] >= PCA_MIN_FIT_TOKENS:
+            _pca_basis.update(mean=mean, components=V, uses=0)
+        return torch.matmul(hidden - mean, V)
 
 
 @app.post("/tokenize")
@@ -64,95 +676,101 @@ def tokenize_text(input: TextInput):
         print("/tokenize error: tokenizer not loaded")
         return {"input_ids": [], "tokens": [], "attention_mask": []}
     try:
-        inputs = tokenizer(input.text, return_tensors="pt", add_special_tokens=True)
-        raw_tokens = tokenizer.convert_ids_to_tokens(inputs["input_ids"][0])
-        input_ids = inputs["input_ids"][0].tolist()
+        # Tokenization only; no forward pass needed here
+        input_ids, attention_mask = _tok(input.text)
+        raw_tokens = tokenizer.convert_ids_to_tokens(input_ids)
+        input_ids = input_ids.tolist()
         
-        # Clean up tokens for better display and remove duplicates
-        cleaned_tokens = []
-        seen_tokens = set()
-        
-        for token in raw_tokens:
-            # Clean the token
-            if token.startswith('Ġ'):
-                clean_token = ' ' + token[1:]
-            else:
-                clean_token = token
-            
-            # Only add if we haven't seen this exact token before
-            if clean_token not in seen_tokens:
-                cleaned_tokens.append(clean_token)
-                seen_tokens.add(clean_token)
+        # Clean up tokens for better display, keeping one entry per input id
+        cleaned_tokens = [(' ' + token[1:]) if token.startswith('Ġ') else token for token in raw_tokens]
         
         return {
             "input_ids": input_ids,
             "tokens": cleaned_tokens,
-            "attention_mask": inputs["attention_mask"].tolist()
+            "attention_mask": [attention_mask.tolist()]
         }
     except Exception as e:
         print("/tokenize error:", e)
         return {"input_ids": [], "tokens": [], "attention_mask": []}
 
+
+def _next_token_response(next_token_logits: torch.Tensor) -> dict:
+    """Top-10 candidates for /next_token; runs in the threadpool, off the event loop"""
+    # Apply softmax to get probabilities
+    probs = torch.softmax(next_token_logits, dim=-1)
+    
+    # Get top 10 probabilities and their corresponding tokens
+    top_probs, top_indices = torch.topk(probs, k=10, dim=-1)
+    
+    # Get raw logits for the top 10 tokens (for softmax animation)
+    top_logits = next_token_logits.gather(-1, top_indices)
+    
+    # Copy everything to the host in one hop and decode all tokens in one call
+    top_probs, top_logits = torch.stack([top_probs, top_logits]).detach().cpu()
+    idx_list = top_indices.tolist()
+    top_tokens = [token.strip() for token in tokenizer.batch_decode([[idx] for idx in idx_list])]
+    
+    # Parallel arrays instead of a dict per candidate; the frontend zips them.
+    # Only 10 values each, so keep full precision (FP16 spacing at logits ~ -100 is ~0.06)
+    return {
+        "token": top_tokens[0],
+        "token_id": idx_list[0],
+        "probability": top_probs[0].item(),
+        "tokens": top_tokens,
+        "probs": encode_tensor(top_probs, dtype="float32"),
+        "logits": encode_tensor(top_logits, dtype="float32")
+    }
+
+
 @app.post("/next_token")
-def next_token_prediction(input: TextInput):
+async def next_token_prediction(input: TextInput):
     """
     Predict next token using GPT-2 model
     
     Args:
-        input: TextInput object containing text for prediction
+        input: TextInput object containing text for prediction; with a session_id
+            only the part of the text that changed since the session's last call is prefilled
         
     Returns:
-        dict: Contains predicted token, token_id, probability, and top 10 probabilities
+        dict: Contains predicted token, token_id, probability, and the top 10 candidates
+            as parallel arrays: tokens, plus probs and logits packed as FP32 buffers
     """
     if tokenizer is None or model is None:
         print("/next_token error: model/tokenizer not loaded")
-        return {"token": "", "token_id": -1, "probability": 0.0, "probs": []}
+        return {"token": "", "token_id": -1, "probability": 0.0, "tokens": [], "probs": [], "logits": []}
     try:
-        # Tokenize input text
-        inputs = tokenizer.encode(input.text, return_tensors="pt")
-        
-        with torch.no_grad():
-            # Get model outputs
-            outputs = model(inputs)
-            logits = outputs.logits
-            
-            # Get the logits for the last token (next token prediction)
-            next_token_logits = logits[0, -1, :]
-            
-            # Apply softmax to get probabilities
-            probs = torch.softmax(next_token_logits, dim=-1)
-            
-            # Get top 10 probabilities and their corresponding tokens
-            top_probs, top_indices = torch.topk(probs, k=10, dim=-1)
-            
-            # Convert to list and get tokens for each probability
-            top_probs_list = top_probs.tolist()
-            top_tokens = [tokenizer.decode([idx.item()]) for idx in top_indices]
-            
-            # Get raw logits for the top 10 tokens (for softmax animation)
-            top_logits = next_token_logits[top_indices].tolist()
-            
-            # Format probabilities for frontend
-            probs_list = [{"token": token.strip(), "prob": prob, "logit": logit} for token, prob, logit in zip(top_tokens, top_probs_list, top_logits)]
-            
-            # Get the top token (highest probability)
-            token = top_tokens[0].strip()
-            token_id = top_indices[0].item()
-            probability = top_probs_list[0]
-            
-        return {
-            "token": token,
-            "token_id": token_id,
-            "probability": probability,
-            "probs": probs_list
-        }
+        # Get the logits for the last token (next token prediction)
+        if input.session_id:
+            next_token_logits = await run_in_threadpool(session_next_token_logits, input.session_id, input.text)
+        else:
+            next_token_logits = (await get_model_outputs(input.text)).next_token_logits
+        return await run_in_threadpool(_next_token_response, next_token_logits)
     except Exception as e:
         print("/next_token error:", e)
-        return {"token": "", "token_id": -1, "probability": 0.0, "probs": []}
+        return {"token": "", "token_id": -1, "probability": 0.0, "tokens": [], "probs": [], "logits": []}
+
+
+def _residual_stream_response(outputs: ModelOutputs) -> ORJSONResponse:
+    """Per-token residual norms for /residual_stream; runs in the threadpool, off the event loop"""
+    hidden_states = outputs.hidden_states  # Tuple of tensors: [layer][seq_len, hidden_dim]
+
+    # Stack to [num_layers, seq_len, hidden_dim] and take every token's norm at once
+    norms = torch.linalg.vector_norm(torch.stack(hidden_states, dim=0), dim=-1)  # [num_layers, seq_len]
+    num_layers = len(hidden_states)
+
+    # Token trajectories (each is [layer_0_val, layer_1_val, ..., layer_n_val]),
+    # left as a NumPy array for orjson to serialize directly
+    token_layer_values = norms.T.contiguous().numpy()
+
+    return ORJSONResponse({
+        "layer_values": token_layer_values,
+        "tokens": tokenizer.convert_ids_to_tokens(outputs.input_ids),
+        "num_layers": num_layers
+    })
 
 
 @app.post("/residual_stream")
-def get_residual_stream(input: TextInput):
+async def get_residual_stream(input: TextInput):
     """
     Compute residual stream evolution (e.g., norm or PCA dimension) across GPT-2 layers.
     
@@ -162,35 +780,25 @@ def get_residual_stream(input: TextInput):
     if tokenizer is None or model is None:
         return {"layer_values": []}
     try:
-        inputs = tokenizer(input.text, return_tensors="pt", add_special_tokens=True)
-        with torch.no_grad():
-            outputs = model(**inputs, output_hidden_states=True)
-        hidden_states = outputs.hidden_states  # List of tensors: [layer, 1, seq_len, hidden_dim]
-
-        # Convert each layer to [seq_len, hidden_dim] and calculate norm per token
-        token_layer_values = []  # List of token trajectories (each is [layer_0_val, layer_1_val, ..., layer_n_val])
-        num_tokens = hidden_states[0].shape[1]
-        num_layers = len(hidden_states)
-
-        for token_idx in range(num_tokens):
-            values_per_layer = []
-            for layer_idx in range(num_layers):
-                vec = hidden_states[layer_idx][0, token_idx]  # Shape: [hidden_dim]
-                values_per_layer.append(torch.norm(vec).item())  # Could also use vec[0].item() for PCA dim
-            token_layer_values.append(values_per_layer)
-
-        return {
-            "layer_values": token_layer_values,
-            "tokens": tokenizer.convert_ids_to_tokens(inputs["input_ids"][0]),
-            "num_layers": num_layers
-        }
+        outputs = await get_model_outputs(input.text)
+        return await run_in_threadpool(_residual_stream_response, outputs)
     except Exception as e:
         print("Error in /residual_stream:", e)
         return {"layer_values": [], "tokens": [], "num_layers": 0}
 
 
+def _attention_response(outputs: ModelOutputs) -> ORJSONResponse:
+    """Packed attention weights for /attention; runs in the threadpool, off the event loop"""
+    attentions = outputs.attentions
+    return ORJSONResponse({
+        "num_layers": len(attentions),
+        # Probabilities in [0, 1] only feed the heatmaps, so 8 bits are plenty
+        "attentions": encode_tensor(torch.stack(attentions, dim=0), dtype="uint8")
+    })
+
+
 @app.post("/attention")
-def get_attention(input: TextInput):
+async def get_attention(input: TextInput):
     """
     Extract attention weights from GPT-2 model
     
@@ -198,27 +806,43 @@ def get_attention(input: TextInput):
         input: TextInput object containing text to analyze
         
     Returns:
-        dict: Contains number of layers and attention matrices for all layers/heads
+        dict: Contains number of layers and attention weights for all layers/heads,
+            packed as a [num_layers, num_heads, seq_len, seq_len] uint8 buffer (weight * 255)
     """
     if tokenizer is None or model is None:
         print("/attention error: model/tokenizer not loaded")
         return {"num_layers": 0, "attentions": []}
     try:
-        inputs = tokenizer(input.text, return_tensors="pt", add_special_tokens=True)
-        with torch.no_grad():
-            outputs = model(**inputs)
-        attentions = outputs.attentions if hasattr(outputs, 'attentions') else []
-        attentions_data = [layer.squeeze(0).tolist() for layer in attentions] if attentions else []
-        return {
-            "num_layers": len(attentions_data),
-            "attentions": attentions_data
-        }
+        outputs = await get_model_outputs(input.text)
+        return await run_in_threadpool(_attention_response, outputs)
     except Exception as e:
         print("/attention error:", e)
         return {"num_layers": 0, "attentions": []}
 
+
+def _embeddings_response(outputs: ModelOutputs) -> ORJSONResponse:
+    """Packed hidden states and 3D PCA for /embeddings; runs in the threadpool, off the event loop"""
+    hidden_states = outputs.hidden_states
+    # embeddings3d: PCA of last hidden state (for visualization)
+    embeddings3d = []
+    if hidden_states and len(hidden_states[-1]) > 0:
+        try:
+            projected = project_3d(hidden_states[-1])
+            if projected is not None:
+                embeddings3d = projected.numpy()
+        except Exception as e:
+            print("PCA error:", e)
+            embeddings3d = []
+    # Always return all keys, even if empty
+    return ORJSONResponse({
+        "num_layers": len(hidden_states),
+        "hidden_states": encode_tensor(torch.stack(hidden_states, dim=0)),
+        "embeddings3d": embeddings3d
+    })
+
+
 @app.post("/embeddings")
-def get_embeddings(input: TextInput):
+async def get_embeddings(input: TextInput):
     """
     Extract hidden states and compute 3D embeddings using PCA
     
@@ -226,34 +850,15 @@ def get_embeddings(input: TextInput):
         input: TextInput object containing text to analyze
         
     Returns:
-        dict: Contains hidden states from all layers and 3D PCA embeddings
+        dict: Contains hidden states from all layers (packed as a
+            [num_layers, seq_len, hidden_dim] FP16 buffer) and 3D PCA embeddings
     """
     if tokenizer is None or model is None:
         print("/embeddings error: model/tokenizer not loaded")
         return {"num_layers": 0, "hidden_states": [], "embeddings3d": []}
     try:
-        inputs = tokenizer(input.text, return_tensors="pt", add_special_tokens=True)
-        with torch.no_grad():
-            outputs = model(**inputs)
-        hidden_states = outputs.hidden_states if hasattr(outputs, 'hidden_states') else []
-        hidden_states_data = [layer.squeeze(0).tolist() for layer in hidden_states] if hidden_states else []
-        # embeddings3d: PCA of last hidden state (for visualization)
-        embeddings3d = []
-        if hidden_states_data and len(hidden_states_data[-1]) > 0:
-            try:
-                last_hidden = np.array(hidden_states_data[-1])  # [seq_len, hidden_dim]
-                if last_hidden.shape[1] >= 3:
-                    pca = PCA(n_components=3)
-                    embeddings3d = pca.fit_transform(last_hidden).tolist()
-            except Exception as e:
-                print("PCA error:", e)
-                embeddings3d = []
-        # Always return all keys, even if empty
-        return {
-            "num_layers": len(hidden_states_data),
-            "hidden_states": hidden_states_data,
-            "embeddings3d": embeddings3d if isinstance(embeddings3d, list) else []
-        }
+        outputs = await get_model_outputs(input.text)
+        return await run_in_threadpool(_embeddings_response, outputs)
     except Exception as e:
         print("/embeddings error:", e)
         return {"num_layers": 0, "hidden_states": [], "embeddings3d": []}
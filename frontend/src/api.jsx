@@ -12,6 +12,75 @@ const API_BASE = "http://localhost:8000"; // Change if needed
  * - Next token predictions with probabilities
  */
 
+// Lookup table from IEEE 754 half-precision bit patterns to JS numbers, built on first use
+let halfTable = null;
+
+const getHalfTable = () => {
+  if (halfTable) return halfTable;
+  halfTable = new Float32Array(65536);
+  for (let h = 0; h < 65536; h++) {
+    const sign = h & 0x8000 ? -1 : 1;
+    const exponent = (h >> 10) & 0x1f;
+    const fraction = h & 0x3ff;
+    if (exponent === 0) {
+      halfTable[h] = sign * Math.pow(2, -14) * (fraction / 1024);
+    } else if (exponent === 31) {
+      halfTable[h] = fraction ? NaN : sign * Infinity;
+    } else {
+      halfTable[h] = sign * Math.pow(2, exponent - 15) * (1 + fraction / 1024);
+    }
+  }
+  return halfTable;
+};
+
+/**
+ * Reshape a flat typed array into nested plain arrays
+ * @param {Float32Array} flat - Flat values in row-major order
+ * @param {number[]} shape - Target shape
+ * @returns {Array} Nested arrays matching shape
+ */
+const reshape = (flat, shape) => {
+  if (shape.length === 0) return flat[0];
+  if (shape.length === 1) return Array.from(flat);
+  const [dim, ...rest] = shape;
+  const stride = rest.reduce((a, b) => a * b, 1);
+  const out = new Array(dim);
+  for (let i = 0; i < dim; i++) {
+    out[i] = reshape(flat.subarray(i * stride, (i + 1) * stride), rest);
+  }
+  return out;
+};
+
+/**
+ * Decode a packed tensor ({ dtype, shape, data }) sent by the backend into nested arrays
+ *
+ * "float16" / "float32" buffers hold IEEE floats; "uint8" buffers hold values in [0, 1]
+ * quantized as round(x * 255) (used for attention weights).
+ * @param {Object|Array} packed - Packed tensor, or an already-plain array (e.g. error responses)
+ * @returns {Array} Nested arrays of numbers
+ */
+export const decodeTensor = (packed) => {
+  if (!packed || Array.isArray(packed)) return packed || [];
+  const binary = atob(packed.data);
+  const bytes = new Uint8Array(binary.length);
+  for (let i = 0; i < binary.length; i++) bytes[i] = binary.charCodeAt(i);
+  let values;
+  if (packed.dtype === "uint8") {
+    values = new Float32Array(bytes.length);
+    for (let i = 0; i < bytes.length; i++) values[i] = bytes[i] / 255;
+  } else if (packed.dtype === "float32") {
+    const view = new DataView(bytes.buffer);
+    values = new Float32Array(bytes.length / 4);
+    for (let i = 0; i < values.length; i++) values[i] = view.getFloat32(i * 4, true);
+  } else {
+    const table = getHalfTable();
+    const halves = new Uint16Array(bytes.buffer);
+    values = new Float32Array(halves.length);
+    for (let i = 0; i < halves.length; i++) values[i] = table[halves[i]];
+  }
+  return reshape(values, packed.shape);
+};
+
 /**
  * Fetch tokenization data for input text
  * @param {string} text - Input text to tokenize
@@ -29,7 +98,7 @@ export const fetchTokenData = async (text) => {
  */
 export const fetchEmbeddings = async (text) => {
   const response = await axios.post(`${API_BASE}/embeddings`, { text });
-  return response.data;
+  return { ...response.data, hidden_states: decodeTensor(response.data.hidden_states) };
 };
 
 /**
@@ -39,7 +108,7 @@ export const fetchEmbeddings = async (text) => {
  */
 export const fetchAttention = async (text) => {
   const response = await axios.post(`${API_BASE}/attention`, { text });
-  return response.data;
+  return { ...response.data, attentions: decodeTensor(response.data.attentions) };
 };
 
 /**
@@ -50,7 +119,13 @@ export const fetchAttention = async (text) => {
 export const fetchNextToken = async (text) => {
   try {
     const response = await axios.post(`${API_BASE}/next_token`, { text });
-    return response.data;
+    const { tokens = [], probs, logits } = response.data;
+    const probValues = decodeTensor(probs);
+    const logitValues = decodeTensor(logits);
+    return {
+      ...response.data,
+      probs: tokens.map((token, i) => ({ token, prob: probValues[i], logit: logitValues[i] }))
+    };
   } catch (e) {
     return null;
   }